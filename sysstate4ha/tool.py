@@ -1,5 +1,5 @@
 import psutil
-import json
+import orjson
 from pathlib import Path
 import logging
 import subprocess
@@ -9,42 +9,42 @@ import socket
 import datetime as dt
 import tomllib
 import os
-from dataclasses import dataclass
+import shutil
+from dataclasses import dataclass, field
 from typing import Callable
-from functools import partial
 import yaml
 import re
+import paho.mqtt.client as mqtt
 
 log = logging.getLogger(__name__)
 
+_RE_UNDERSCORES = re.compile(r"_+")
+_RE_TRAILING = re.compile(r"_$")
+
 
 class CPUUsage:
     """use psutil to get CPU usage
 
     key feature: getter returns a function with no arguments that returns the cpu usage for
     a single core (what is an integer) or the average (what is 'all'). Since psutil's
-    cpu_percent yields average values with respect to the last call, values are cached until
-    an already fetched quantity is fetched again.
+    cpu_percent yields average values with respect to the last call, values are sampled
+    once per publish loop by calling tick() and served from cache in between.
     """
 
     def __init__(self):
-        self.update()
+        self.tick()
 
-    def get(self, what):
-        if what in self.fetched:
-            self.update()
-        self.fetched.add(what)
+    def getter(self, what):
+        # resolve 'what' once here, not on every call in the publish loop
         if what == "all":
-            return self.cpu_usage_avrg
+            return lambda: self.cpu_usage_avrg
         else:
-            return self.cpu_usage[what]
-
-    def getter(self, what):
-        return partial(self.get, what=what)
+            return lambda: self.cpu_usage[what]
 
-    def update(self):
-        self.fetched = set()
+    def tick(self):
         self.cpu_usage = psutil.cpu_percent(percpu=True)
+        # builtin sum on the list psutil returns is faster than converting to a numpy
+        # array first, even with 128 cores
         self.cpu_usage_avrg = int(10*sum(self.cpu_usage) / len(self.cpu_usage)) / 10
         log.debug("new cpu_percent data cached")
 
@@ -70,50 +70,56 @@ def get_machine_product_name():
             return pn
     # fall back for Raspberry Pi
     with open("/proc/cpuinfo", "r") as f:
-        for l in f:
-            pass
-        if l.startswith("Model"):
-            pn = l.split(":")[1].strip()
-            log.info(f"machine product name: {pn} (last line of /proc/cpuinfo)")
+        lines = f.read().splitlines()
+    for line in lines:
+        if line.startswith("Model"):
+            pn = line.split(":", 1)[1].strip()
+            log.info(f"machine product name: {pn} (Model line of /proc/cpuinfo)")
             return pn
 
     raise RuntimeError("Failed to get machine product name")
 
 
-def get_uptime():
-    if (p := Path("/proc/uptime")).exists():
-        with open(p, "r") as f:
-            ut_sec = int(float(f.readline().split()[0]))
-            return str(dt.timedelta(seconds=ut_sec))
+def get_disk_percent(mountpoint):
+    """same value as psutil.disk_usage(mountpoint).percent from a single statvfs call"""
+    s = os.statvfs(mountpoint)
+    used = s.f_blocks - s.f_bfree
+    total = used + s.f_bavail
+    return round(100 * used / total, 1) if total > 0 else 0.0
 
-    RuntimeError("Failed to get uptime")
 
+# replaces characters that are not allowed in topics and ids
+_QUAL_NAME_TABLE = str.maketrans({" ": "_", "/": "_"})
 
+
+@dataclass(slots=True)
 class Entity:
     """abstraction layer for entities to generalize"""
 
-    def __init__(
-        self,
-        name: str,
-        mid: str,
-        unit_of_measurement: str,
-        get: Callable,
-        yaml_keys: dict = {},
-        full_name: str | None = None,
-        card_name: str | None = None,
-    ):
-        self.name = name
-        self.mid = mid
-        self.unit_of_measurement = unit_of_measurement
-        self.get = get
-        self.yaml_keys = yaml_keys
-        self.full_name = full_name
-        self.card_name = name if card_name is None else card_name
-
-        self.qual_name = self.name.replace(" ", "_").replace("/", "_").lower()
-        self.state_topic = f"{self.mid}/{self.qual_name}"
+    name: str
+    mid: str
+    unit_of_measurement: str
+    get: Callable
+    yaml_keys: dict = field(default_factory=dict)
+    full_name: str | None = None
+    card_name: str | None = None
+    # minimal change of the value that triggers a publish,
+    # None means changes alone never trigger one (value is sent along with others)
+    epsilon: float | None = 0
+
+    # derived in __post_init__
+    qual_name: str = field(init=False)
+    state_topic: str = field(init=False)
+    unique_id: str = field(init=False)
+
+    def __post_init__(self):
+        if self.card_name is None:
+            self.card_name = self.name
+
+        self.qual_name = self.name.translate(_QUAL_NAME_TABLE).lower()
+        # all entities share one state topic carrying a JSON object per update
+        self.state_topic = f"{self.mid}/state"
         self.unique_id = f"{self.mid}_{self.qual_name}"
-        
 
 
 class SysState4HA:
@@ -123,6 +129,7 @@ class SysState4HA:
         mqtt_user,
         mqtt_password,
         update_interval=2,
+        refresh_every=30,
         len_id=6,
         host_alias="",
         origin_name="linux mosquitto",
@@ -135,13 +142,20 @@ class SysState4HA:
         self.user = mqtt_user
         self.passowrd = mqtt_password
         self.interval = update_interval
+        if refresh_every < 1:
+            raise ValueError(f"refresh_every must be at least 1, got {refresh_every}")
+        self.refresh_every = refresh_every
 
         self.ncpu = psutil.cpu_count()
         self.disk_parts = psutil.disk_partitions()
 
-        self.base_cmd = (
-            f"mosquitto_pub -h {self.host} -r -u {self.user} -P {self.passowrd}"
-        )
+        # one persistent connection, established on first use (see _connect)
+        self.mqtt = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.mqtt.username_pw_set(self.user, self.passowrd)
+        self._connected = False
+
+        # kept open and re-read on every tick with a single pread
+        self._uptime_fd = os.open("/proc/uptime", os.O_RDONLY)
 
         self.cpu_usage = CPUUsage()
 
@@ -153,6 +167,7 @@ class SysState4HA:
                 mid=self.mid,
                 unit_of_measurement="%",
                 get=self.cpu_usage.getter("all"),
+                epsilon=0.5,
                 yaml_keys={
                     "type": "custom:bar-card",
                     "entity_row": "true",
@@ -168,6 +183,7 @@ class SysState4HA:
                     mid=self.mid,
                     unit_of_measurement="%",
                     get=self.cpu_usage.getter(i - 1),
+                    epsilon=0.5,
                     yaml_keys={
                         "type": "custom:bar-card",
                         "entity_row": "true",
@@ -187,9 +203,8 @@ class SysState4HA:
                     full_name=f"{dp.device}: {dp.mountpoint} ({dp.fstype})",
                     mid=self.mid,
                     unit_of_measurement="%",
-                    get=partial(
-                        lambda x: psutil.disk_usage(x).percent, x=dp.mountpoint
-                    ),
+                    get=lambda mp=dp.mountpoint: get_disk_percent(mp),
+                    epsilon=0.5,
                     yaml_keys={
                         "type": "custom:bar-card",
                         "entity_row": "true",
@@ -200,11 +215,22 @@ class SysState4HA:
         # uptime
         self.entities.append(
             Entity(
-                name="uptime", mid=self.mid, unit_of_measurement=None, get=get_uptime,
-                yaml_keys={'icon': 'mdi:timelapse'}
+                name="uptime",
+                mid=self.mid,
+                unit_of_measurement=None,
+                get=self.get_uptime,
+                epsilon=None,
+                yaml_keys={"icon": "mdi:timelapse"},
             )
         )
 
+        # entities are fixed from here on
+        self._discovery_json = self._generate_discovery_JSON()
+
+    def get_uptime(self):
+        ut_sec = int(float(os.pread(self._uptime_fd, 64, 0).split()[0]))
+        return str(dt.timedelta(seconds=ut_sec))
+
     def _generate_discovery_JSON(self):
         cmps = {}
         for e in self.entities:
@@ -214,6 +240,7 @@ class SysState4HA:
                 "state_topic": e.state_topic,
                 "unique_id": e.unique_id,
                 "unit_of_measurement": e.unit_of_measurement,
+                "value_template": f"{{{{ value_json['{e.qual_name}'] }}}}",
             }
 
         data = {
@@ -226,51 +253,126 @@ class SysState4HA:
             },
         }
 
-        return json.dumps(data, sort_keys=True, indent=4)
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
 
     #####################################
     ## commands
     #####################################
 
+    def _connect(self, retry=False):
+        """connect to the broker and start paho's network thread, if not done already
+
+        With retry=False wait for CONNACK, so a refused login fails loudly.
+        With retry=True return immediately and let the network thread retry until
+        the broker is reachable, e.g., when the service starts before the network.
+        """
+        if self._connected:
+            return
+        if retry:
+            self.mqtt.connect_async(self.host)
+        else:
+            self.mqtt.connect(self.host)
+            while not self.mqtt.is_connected():
+                if (rc := self.mqtt.loop()) != mqtt.MQTT_ERR_SUCCESS:
+                    raise RuntimeError(
+                        f"failed to connect to {self.host} ({mqtt.error_string(rc)})"
+                    )
+        self.mqtt.loop_start()
+        self._connected = True
+
+    def _pub_wait(self, value, topic, timeout=10):
+        """publish and block until the message went out, used by one-shot commands"""
+        self._connect()
+        info = self.mqtt.publish(topic, value, retain=True)
+        info.wait_for_publish(timeout)
+        if not info.is_published():
+            raise RuntimeError(f"failed to publish to {topic} within {timeout}s")
+
+    def close(self):
+        if self._connected:
+            self.mqtt.loop_stop()
+            self.mqtt.disconnect()
+            self._connected = False
+            log.debug("mqtt connection closed")
+        os.close(self._uptime_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def expose(self, **kwargs):
-        js = self._generate_discovery_JSON().replace('"', r"\"")
-        cmd = f'{self.base_cmd} -t homeassistant/device/{self.mid}/config -m "{js}"'
-        log.debug(f"run cmd: {cmd}")
-        subprocess.run(cmd, shell=True, check=True, capture_output=False)
+        self._pub_wait(self._discovery_json, f"homeassistant/device/{self.mid}/config")
         log.info(f"expose device/{self.mid} successful")
 
     def remove(self, **kwargs):
-        cmd = f'{self.base_cmd} -t homeassistant/device/{self.mid}/config -m ""'
-        log.debug(f"run cmd: {cmd}")
-        subprocess.run(cmd, shell=True, check=True, capture_output=False)
+        self._pub_wait("", f"homeassistant/device/{self.mid}/config")
         log.info(f"remove device/{self.mid} successful")
 
     def _pub(self, value, topic):
-        cmd = f"{self.base_cmd} -t {topic} -m \"{value}\""
-        log.debug(f"run cmd: {cmd}")
-        r = subprocess.run(cmd, shell=True, capture_output=False)
-        if r.returncode == 0:
-            log.debug(f"publish {value} to {topic} sucessfull")
+        """publish without waiting, return whether paho accepted the message"""
+        info = self.mqtt.publish(topic, value, retain=True, qos=0)
+        # called every tick, let logging do the formatting only if the record is emitted
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            log.debug("publish %s to %s sucessfull", value, topic)
+            return True
         else:
-            log.warning(f"failed to publish {value} to {topic} ({r.stderr})")
+            log.warning(
+                "failed to publish %s to %s (%s)",
+                value,
+                topic,
+                mqtt.error_string(info.rc),
+            )
+            return False
+
+    def _changed(self, payload, last):
+        for e in self.entities:
+            if e.epsilon is None:
+                continue
+            new = payload[e.qual_name]
+            old = last.get(e.qual_name)
+            if old is None or (new != old and abs(new - old) >= e.epsilon):
+                return True
+        return False
 
     def publish(self, **kwargs):
+        """publish the entity values every update_interval seconds until interrupted
+
+        mqtt.publish only queues the message, sending is done by paho's network thread.
+        So a slow broker does not delay collecting the values of the next tick.
+        """
+        self._connect(retry=True)
+        last = {}
+        tick_no = 0
+        deadline = time.monotonic()
         try:
             while True:
-                t0 = time.perf_counter()
-                for e in self.entities:
-                    self._pub(e.get(), e.state_topic)
-
-                t1 = time.perf_counter()
-                time.sleep(s if (s := self.interval - (t1 - t0)) > 0 else 0)
+                self.cpu_usage.tick()
+                payload = {e.qual_name: e.get() for e in self.entities}
+                # send only significant changes, but refresh everything now and then
+                if tick_no % self.refresh_every == 0 or self._changed(payload, last):
+                    # on failure keep the old reference, so the change is sent again
+                    if self._pub(orjson.dumps(payload), f"{self.mid}/state"):
+                        last = payload
+                else:
+                    log.debug("no significant change, skip publish")
+                tick_no += 1
+
+                # fixed schedule without drift; after an overlong tick, skip the
+                # missed slots instead of catching up with a burst of updates
+                deadline += self.interval
+                if (s := deadline - time.monotonic()) < 0:
+                    deadline -= s
+                    s = 0
+                time.sleep(s)
         except KeyboardInterrupt:
             pass
 
     def prepare_install(self, conf, **kwargs):
         conf = Path(conf).absolute()
         r = subprocess.run(
-            "ps --no-headers -o comm 1",
-            shell=True,
+            ["ps", "--no-headers", "-o", "comm", "1"],
             check=True,
             capture_output=True,
             text=True,
@@ -281,10 +383,8 @@ class SysState4HA:
 
         package_root = Path(__file__).parent.parent.absolute()
 
-        r = subprocess.run(
-            "whereis poetry", shell=True, check=True, capture_output=True, text=True
-        )
-        poetry_path = r.stdout.split(":")[1].strip()
+        if (poetry_path := shutil.which("poetry")) is None:
+            raise RuntimeError("poetry not found in PATH")
 
         user = os.getlogin()
 
@@ -322,9 +422,9 @@ systemctl start s4h.service
         for e in self.entities:
             entity_qual_name = f"sensor.{self.host_alias}_{e.qual_name}"
             # reduce multiple '_' to only one
-            entity_qual_name = re.sub(r'_+', '_', entity_qual_name)
+            entity_qual_name = _RE_UNDERSCORES.sub("_", entity_qual_name)
             # remove trailing '_'
-            entity_qual_name = re.sub(r'_$', '', entity_qual_name)
+            entity_qual_name = _RE_TRAILING.sub("", entity_qual_name)
 
             entities_list.append(
                 {
@@ -350,8 +450,9 @@ def cli():
 
     parser.add_argument(
         "cmd",
-        help="what to do",
+        help="what to do, several commands run in order on one mqtt connection",
         choices=["expose", "remove", "publish", "prepare_install", "test"],
+        nargs="+",
     )
     parser.add_argument("-c", "--conf", help="path to config toml", required=True)
     parser.add_argument(
@@ -370,8 +471,9 @@ def cli():
     with open(args.conf, "rb") as f:
         conf = tomllib.load(f)
 
-    h = SysState4HA(**conf["SysState4HA"])
-    getattr(h, args.cmd)(**vars(args))
+    with SysState4HA(**conf["SysState4HA"]) as h:
+        for cmd in args.cmd:
+            getattr(h, cmd)(**vars(args))
 
 
 if __name__ == "__main__":